@@ -0,0 +1,142 @@
+import re
+import unicodedata
+
+import pandas as pd
+
+# Street-type and title abbreviations found in the export, expanded before lookup
+ABBREVIATIONS = {
+    'all': 'allee',
+    'av': 'avenue',
+    'ave': 'avenue',
+    'bd': 'boulevard',
+    'bld': 'boulevard',
+    'bvd': 'boulevard',
+    'ch': 'chemin',
+    'che': 'chemin',
+    'crs': 'cours',
+    'fbg': 'faubourg',
+    'fg': 'faubourg',
+    'gal': 'general',
+    'gen': 'general',
+    'imp': 'impasse',
+    'pl': 'place',
+    'qu': 'quai',
+    'r': 'rue',
+    'res': 'residence',
+    'rte': 'route',
+    'sq': 'square',
+    'st': 'saint',
+    'ste': 'sainte',
+}
+
+_ABBREVIATION_PATTERN = re.compile(r'\b(' + '|'.join(ABBREVIATIONS) + r')\b')
+_POSTAL_CODE_PATTERN = re.compile(r'\b(\d{5})\b')
+_TRAILING_PATTERN = re.compile(r'france|cedex( \d+)?')
+_TRAILING_SUFFIX_PATTERN = re.compile(r'(\s*\b(france|cedex( \d+)?))+$')
+
+
+def simplify_text(text):
+    """Lower-case, strip accents and punctuation, and collapse whitespace."""
+    text = unicodedata.normalize('NFKD', str(text))
+    text = ''.join(char for char in text if not unicodedata.combining(char)).casefold()
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', text).split())
+
+
+def normalize_street(text):
+    """Simplify a street label and expand its abbreviations ('Bd St-Michel' -> 'boulevard saint michel')."""
+    return _ABBREVIATION_PATTERN.sub(lambda match: ABBREVIATIONS[match.group(1)], simplify_text(text))
+
+
+def split_address(address):
+    """
+    Split a raw address into its street and its place ('02120 sains richaumont').
+
+    The place is what follows the first comma, or, in an address without
+    commas, what starts at its postal code. A country or CEDEX mention is only
+    dropped from the end of the place, never from the street, so 'Avenue
+    Anatole France' or 'Rue de France' keep their name.
+
+    Returns:
+        tuple: (street, place), normalized with normalize_street.
+    """
+    parts = [normalize_street(part) for part in str(address).split(',')]
+    parts = [part for part in parts if part]
+    # A country or CEDEX part of its own always trails the address
+    while len(parts) > 1 and _TRAILING_PATTERN.fullmatch(parts[-1]):
+        parts.pop()
+    if not parts:
+        return '', ''
+    street, place = parts[0], ' '.join(parts[1:])
+    if not place:
+        found = _POSTAL_CODE_PATTERN.search(street)
+        if found and found.start() > 0:
+            street, place = street[:found.start()].strip(), street[found.start():]
+    place = _TRAILING_SUFFIX_PATTERN.sub('', place)
+    return street, place
+
+
+def normalize_address(address, postal_code=None, locality=None):
+    """
+    Canonicalize an address so formatting variants share one geocode.
+
+    The street part is simplified and its abbreviations expanded; the postal
+    code, locality and country that follow it are dropped and appended back
+    in a fixed form, from the PostalCode and Locality columns when available.
+
+    Parameters:
+        address (str): The raw address.
+        postal_code (str): The client's postal code, if known.
+        locality (str): The client's locality, if known.
+
+    Returns:
+        str: e.g. '15 rue du general de gaulle, 02120 sains richaumont, france'.
+    """
+    street, place = split_address(address)
+
+    if pd.isna(postal_code) or not str(postal_code).strip():
+        found = _POSTAL_CODE_PATTERN.search(place)
+        postal_code = found.group(1) if found else ''
+    postal_code = str(postal_code).strip()
+
+    if pd.isna(locality) or not simplify_text(locality):
+        # The locality is what remains of the place once its postal code is removed
+        locality = ' '.join(_POSTAL_CODE_PATTERN.sub(' ', place).split())
+    else:
+        locality = simplify_text(locality)
+
+    place = ' '.join(part for part in (postal_code, locality) if part)
+    return ', '.join(part for part in (street, place, 'france') if part)
+
+
+def normalize_addresses(data):
+    """
+    Canonicalize the addresses of a client DataFrame.
+
+    Parameters:
+        data (DataFrame): Clients with 'Address', 'PostalCode' and 'Locality' columns.
+
+    Returns:
+        Series: The canonical geocoding query of every row, NA where Address is missing.
+    """
+    columns = data[['Address', 'PostalCode', 'Locality']].astype(object)
+    # Normalize each distinct (address, postal code, locality) once
+    unique = columns.drop_duplicates()
+    unique = unique.assign(Query=[
+        None if pd.isna(address) else normalize_address(address, postal_code, locality)
+        for address, postal_code, locality in unique.itertuples(index=False)
+    ])
+    keys = ['Address', 'PostalCode', 'Locality']
+    queries = columns.merge(unique, on=keys, how='left')['Query']
+    queries.index = data.index
+    return queries.astype('string')
+
+
+def saved_lookups(data):
+    """
+    Return how many lookups normalization saves.
+
+    Without it, every distinct (address, postal code, locality) would be looked
+    up; with it, only every distinct query is.
+    """
+    raw = data.loc[data['Query'].notna(), ['Address', 'PostalCode', 'Locality']].astype(object)
+    return int(len(raw.drop_duplicates()) - data['Query'].nunique())
@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from addresses import simplify_text
+from geometry import DATA_DIR, name_key
+
+# Commune centroids per department, plus one row per department with an empty locality.
+# Built from the GeoNames cities500 dump (CC BY 4.0, places of 500+ inhabitants), each place
+# assigned to its department by point-in-polygon; department rows are polygon centroids.
+COMMUNE_CENTROIDS_PATH = os.path.join(DATA_DIR, "commune-centroids.csv")
+
+
+def load_centroids(path=COMMUNE_CENTROIDS_PATH):
+    """Load the bundled centroid table, indexed by (department, locality)."""
+    centroids = pd.read_csv(
+        path,
+        dtype={'department': 'string', 'locality': 'string', 'lat': float, 'lng': float},
+        keep_default_na=False,
+    )
+    return centroids.set_index(['department', 'locality'])
+
+
+def department_codes(postal_codes):
+    """Vectorized department code of French postal codes (Corsica split into 2A/2B)."""
+    postal_codes = postal_codes.astype('string').str.strip().str.zfill(5)
+    codes = postal_codes.str[:2]
+    corsica = codes.eq('20').fillna(False)
+    south = postal_codes.str[:3].isin(['200', '201']).fillna(False)
+    return codes.mask(corsica & south, '2A').mask(corsica & ~south, '2B')
+
+
+def approximate_coordinates(data, centroids, codes_by_name=None):
+    """
+    Place clients at the centroid of their commune, or of their department.
+
+    The department comes from the postal code, or from the department name
+    of clients without one.
+
+    Parameters:
+        data (DataFrame): Clients with 'PostalCode', 'Locality' and 'AdministrativeArea2' columns.
+        centroids (DataFrame): Table returned by load_centroids.
+        codes_by_name (dict): Normalized department name -> code, see
+                              geometry.department_codes_by_name.
+
+    Returns:
+        DataFrame: 'lat', 'lng' and 'Precision' ('commune', 'department' or NA),
+                   aligned with data.
+    """
+    codes = department_codes(data['PostalCode'])
+    if codes_by_name:
+        names = data['AdministrativeArea2'].astype(object).map(name_key, na_action='ignore')
+        codes = codes.fillna(names.map(codes_by_name).astype('string'))
+    keys = pd.DataFrame({
+        'department': codes.array,
+        'locality': data['Locality'].astype(object).map(simplify_text, na_action='ignore').astype('string').array,
+    })
+    communes = keys.join(centroids, on=['department', 'locality'])
+    departments = keys[['department']].assign(locality='').join(centroids, on=['department', 'locality'])
+
+    found = communes['lat'].notna()
+    result = pd.DataFrame({
+        'lat': communes['lat'].where(found, departments['lat']).to_numpy(),
+        'lng': communes['lng'].where(found, departments['lng']).to_numpy(),
+    }, index=data.index)
+    precision = np.select(
+        [found.to_numpy(), departments['lat'].notna().to_numpy()], ['commune', 'department'], default=None
+    )
+    result['Precision'] = pd.array(precision, dtype='string')
+    return result
+
+
+def locate_clients(data, coords, centroids, codes_by_name=None):
+    """
+    Attach coordinates to clients, falling back on centroids where geocoding failed.
+
+    Parameters:
+        data (DataFrame): Clients with 'Query', 'PostalCode' and 'Locality' columns.
+        coords (DataFrame): 'lat' and 'lng' columns indexed by query.
+        centroids (DataFrame): Table returned by load_centroids.
+        codes_by_name (dict): Normalized department name -> code, for clients without a postal code.
+
+    Returns:
+        DataFrame: The clients with 'lat', 'lng' and 'Precision' ('exact',
+                   'commune' or 'department'); clients that could not be
+                   placed at all are left out.
+    """
+    data = data.join(coords, on='Query').assign(Precision='exact')
+    unresolved = data['lat'].isna()
+    if unresolved.any():
+        data.loc[unresolved, ['lat', 'lng', 'Precision']] = approximate_coordinates(
+            data[unresolved], centroids, codes_by_name
+        )
+    return data.dropna(subset=['lat', 'lng'])
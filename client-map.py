@@ -1,9 +1,29 @@
+import folium
 import pandas as pd
 import streamlit as st
-import requests
-import folium
 import os
-from opencage.geocoder import OpenCageGeocode
+from streamlit_folium import st_folium
+
+from addresses import saved_lookups
+from centroids import load_centroids, locate_clients
+from clustering import ClusterIndex
+from dataset import ClientSource, SnapshotRefresher
+from geocache import GEOCODE_MISS_TTL, GeocodeStore
+from geocoding import GeocoderClient, RateLimitExceededError, geocode_batch, get_geocode, is_transient
+from geometry import DepartmentGeometry, load_departments_geojson
+from reference import geocode_locally
+from rendering import (
+    MAP_CLUSTER_INDEX_CACHE_SIZE,
+    MAP_CLUSTER_INDEX_TTL,
+    RenderCache,
+    add_server_layer,
+    build_department_map,
+    build_map,
+    choose_mode,
+    data_version,
+    department_frame,
+    render_html,
+)
 
 st.set_page_config(layout="wide")
 
@@ -14,35 +34,215 @@ OPEN_CAGE_API_KEY = st.secrets["API_KEY"]
 # Caching functions to speed up repeated runs
 # =============================================================================
 
-@st.cache_data(show_spinner=False)
+@st.cache_resource(show_spinner=False)
+def get_client_source():
+    """Create the client export source shared by every session of the process."""
+    return ClientSource()
+
+@st.cache_resource(show_spinner=False)
+def get_refresher():
+    """Start the background thread that keeps the client snapshot fresh."""
+    geocoder = get_geocoder(OPEN_CAGE_API_KEY)
+    store = get_geocode_store()
+
+    def geocode(addresses):
+        coords, errors = geocode_batch(
+            addresses, lambda query: get_geocode(query, geocoder), store=store, local=geocode_locally
+        )
+        # Transient failures are left out so the next refresh tries them again
+        return coords.drop(index=[query for query, e in errors.items() if is_transient(e)])
+
+    return SnapshotRefresher(get_client_source(), geocode).start()
+
 def load_data():
-    """Load client data from CSV."""
-    url = "http://metabase.prod.tessan.cloud/public/question/6c3c45ab-7379-4815-8941-dcd6763c555c.csv"
-    clients = pd.read_csv(url)
-    return clients
+    """Return the current client snapshot, refreshed in the background."""
+    return get_refresher().snapshot()
+
+@st.cache_resource(show_spinner=False)
+def get_geocode_store():
+    """Open the persistent geocode store once per process."""
+    return GeocodeStore()
+
+@st.cache_resource(show_spinner=False)
+def get_departments_geojson():
+    """Load the French departments GeoJSON once per process from its local file."""
+    return load_departments_geojson()
+
+@st.cache_resource(show_spinner=False)
+def get_department_geometry():
+    """Precompute the simplified department outlines once per process."""
+    return DepartmentGeometry(get_departments_geojson())
+
+@st.cache_resource(show_spinner=False)
+def get_centroids():
+    """Load the bundled commune and department centroids once per process."""
+    return load_centroids()
+
+@st.cache_resource(show_spinner=False)
+def get_geocoder(api_key):
+    """Create the pooled OpenCage client shared by every session of the process."""
+    return GeocoderClient(api_key)
+
+@st.cache_resource(show_spinner=False, max_entries=MAP_CLUSTER_INDEX_CACHE_SIZE, ttl=MAP_CLUSTER_INDEX_TTL)
+def get_cluster_index(selection):
+    """Keep a server-side cluster index per recent department selection, updated in place."""
+    return ClusterIndex()
+
+def map_view(state):
+    """Extract the (zoom, bounds) of the view reported back by st_folium, if any."""
+    if not state or not state.get('bounds') or state.get('zoom') is None:
+        return None
+    south_west, north_east = state['bounds']['_southWest'], state['bounds']['_northEast']
+    if south_west.get('lat') is None:
+        return None
+    return state['zoom'], [[south_west['lat'], south_west['lng']], [north_east['lat'], north_east['lng']]]
+
+def view_center(view):
+    """Return the [lat, lng] center of a (zoom, bounds) view."""
+    (south, west), (north, east) = view[1]
+    return [(south + north) / 2, (west + east) / 2]
+
+@st.cache_resource(show_spinner=False)
+def get_render_cache():
+    """Create the LRU cache of rendered maps shared by every session."""
+    return RenderCache()
+
+def build_client_map(data, selected_departments, mode):
+    """Build the folium map of the selected clients over their department outlines."""
+    return build_department_map(data, get_department_geometry(), selected_departments, mode)
+
+class GeocodingIncomplete(Exception):
+    """Carries a partial batch out of the cached lookup so it is not memoized."""
 
-@st.cache_data(show_spinner=False)
-def get_geocode(query, api_key=OPEN_CAGE_API_KEY):
+    def __init__(self, coords, errors):
+        super().__init__(f"{len(errors)} transient geocoding failures")
+        self.coords = coords
+        self.errors = errors
+
+@st.cache_data(show_spinner=False, ttl=GEOCODE_MISS_TTL)
+def lookup_addresses(addresses, api_key):
     """
-    Get latitude and longitude for a given address using the OpenCage API.
-    
+    Geocode a batch of addresses, memoizing only batches without transient failures.
+
+    Raises:
+        GeocodingIncomplete: Some lookups failed for a reason unrelated to the address
+                             (outage, timeout, quota); st.cache_data does not keep results
+                             that raise, so the next run tries them again.
+    """
+    geocoder = get_geocoder(api_key)
+    coords, errors = geocode_batch(
+        addresses,
+        lambda query: get_geocode(query, geocoder),
+        store=get_geocode_store(),
+        local=geocode_locally,
+    )
+    transient = {query: e for query, e in errors.items() if is_transient(e)}
+    for query, e in errors.items():
+        if query not in transient:
+            st.error(f"Error geocoding {query}: {e}")
+    if transient:
+        raise GeocodingIncomplete(coords.drop(index=list(transient)), transient)
+    return coords
+
+def geocode_addresses(addresses, api_key=OPEN_CAGE_API_KEY):
+    """
+    Geocode a batch of addresses using the OpenCage API.
+
+    Each distinct address is resolved once: the persistent store is consulted
+    first, then the local address reference, and the remaining misses are
+    looked up concurrently, queued behind the rate limit shared by every session.
+
     Parameters:
-        query (str): The address to geocode.
+        addresses (tuple): The addresses to geocode.
         api_key (str): Your OpenCage API key.
-    
+
     Returns:
-        tuple: (latitude, longitude) or (None, None) if not found.
+        DataFrame: 'lat' and 'lng' columns indexed by query, NaN if not found.
     """
-    geocoder = OpenCageGeocode(api_key)
     try:
-        result = geocoder.geocode(query)
-        if result and len(result) > 0:
-            return result[0]['geometry']['lat'], result[0]['geometry']['lng']
-        else:
-            return None, None
-    except Exception as e:
-        st.error(f"Error geocoding {query}: {e}")
-        return None, None
+        return lookup_addresses(addresses, api_key)
+    except GeocodingIncomplete as incomplete:
+        # One notice per cause instead of an error per address
+        over_quota = sum(isinstance(e, RateLimitExceededError) for e in incomplete.errors.values())
+        if over_quota:
+            st.warning(f"Quota OpenCage épuisé : {over_quota} adresses seront géocodées après sa remise à zéro.")
+        if len(incomplete.errors) > over_quota:
+            st.warning(
+                f"OpenCage ne répond pas : {len(incomplete.errors) - over_quota} adresses "
+                "seront géocodées au prochain chargement."
+            )
+        return incomplete.coords
+
+# =============================================================================
+# Page sections, re-executed on their own through fragments
+# =============================================================================
+
+@st.fragment
+def show_details(data):
+    """Show the client table behind the "Voir en détail" toggle."""
+    display_dataframe = st.toggle("Voir en détail")
+    columns_to_display = ['Name', 'Address', 'PostalCode', 'Locality', 'AdministrativeArea2', 'Precision']
+    if display_dataframe:
+        st.dataframe(data[columns_to_display])
+
+def show_download_button(html_data):
+    """Offer the rendered map as a standalone HTML file."""
+    st.download_button(
+        label="Download Map",
+        data=html_data,
+        file_name='client_map.html',
+        mime="text/html",
+        on_click="ignore",
+    )
+
+@st.fragment
+def show_map(data, selected_departments):
+    """Build (or reuse) and display the client map with its download button."""
+    # -----------------------------------------------------------------------------
+    # Build and Display the Map using Folium
+    # -----------------------------------------------------------------------------
+
+    # Above the server-side threshold only cluster centroids of the current view are sent
+    mode = choose_mode(len(data))
+    selection = tuple(sorted(selected_departments))
+    map_key = "client_map-" + "|".join(selection)
+    if mode != 'server':
+        # Reruns with the same selection and data reuse the rendered HTML
+        html_data = get_render_cache().get_or_render(
+            (selection, data_version(data), mode),
+            lambda: render_html(build_client_map(data, selected_departments, mode)),
+        )
+        show_download_button(html_data)
+        st.components.v1.html(html_data.decode('utf-8'), height=600, scrolling=True)
+        return
+
+    index = get_cluster_index(selection)
+    index.update(data)
+    view = map_view(st.session_state.get(map_key))
+
+    # The base map only holds the outlines, so it is not remounted when the view changes;
+    # the clusters or clients of the view are sent as a layer added to it in place
+    outlines, zoom, location = department_frame(data, get_department_geometry(), selected_departments)
+    folium_map = build_map(data.iloc[:0], outlines, zoom, location=location)
+    clients = folium.FeatureGroup(name="Clients")
+    add_server_layer(clients, data, index, view or (zoom, None))
+
+    download = st.empty()
+    # Report pans and zooms back so the next run sends the matching clusters or clients
+    st_folium(
+        folium_map,
+        key=map_key,
+        height=600,
+        use_container_width=True,
+        returned_objects=['zoom', 'bounds'],
+        feature_group_to_add=clients,
+        zoom=view[0] if view else None,
+        center=view_center(view) if view else None,
+    )
+    # The downloaded map holds the layer of the current view
+    clients.add_to(folium_map)
+    with download:
+        show_download_button(render_html(folium_map).encode('utf-8'))
 
 # =============================================================================
 # Main App
@@ -51,18 +251,16 @@ def get_geocode(query, api_key=OPEN_CAGE_API_KEY):
 def main():
     st.title("Clients TESSAN")
 
-    # Load data and drop rows missing an Address
-    data = load_data()
-    data = data.dropna(subset=['Address'])
+    # Load data; its department index only holds rows with an Address
+    snapshot = load_data()
     
     # -----------------------------------------------------------------------------
     # Sidebar: Filtering BEFORE geocoding
     # -----------------------------------------------------------------------------
     st.sidebar.header("Filtre")
     
-    # Get unique values for filtering from the CSV data
-    # For example, filter by department ("AdministrativeArea2")
-    departments = sorted(data['AdministrativeArea2'].dropna().unique().tolist())
+    # Department options ("AdministrativeArea2") are precomputed with the snapshot
+    departments = snapshot.departments.options
     
     placeholder = "Aucun"
     department_options = [placeholder] + departments
@@ -73,7 +271,7 @@ def main():
         st.info("Veuillez choisir un département pour continuer.")
         st.stop()
 
-    data = data[data['AdministrativeArea2'].isin(selected_departments)]
+    data = snapshot.departments.select(selected_departments)
 
     # If no data remains after filtering, notify the user and exit
     if data.empty:
@@ -83,76 +281,47 @@ def main():
     # -----------------------------------------------------------------------------
     # Geocode Addresses (only for the filtered data)
     # -----------------------------------------------------------------------------
-    data[['lat', 'lng']] = data['Address'].apply(lambda x: pd.Series(get_geocode(x)))
-    
-    # Remove rows where geocoding failed
-    data = data.dropna(subset=['lat', 'lng'])
-    
-    if data.empty:
-        st.warning("No valid geocoding results for the selected data.")
-        return
+    # Addresses are geocoded by their normalized query, so formatting variants share a lookup.
+    # Coordinates come with the snapshot; only queries it has not resolved yet are looked up
+    coords = snapshot.coords
+    missing = sorted(set(data['Query'].dropna().unique()).difference(coords.index))
+    if missing:
+        coords = pd.concat([coords, geocode_addresses(tuple(missing))])
 
-    # -----------------------------------------------------------------------------
-    # Build and Display the Map using Folium
-    # -----------------------------------------------------------------------------
-    
-    # Load French departments GeoJSON
-    geojson_url = 'https://france-geojson.gregoiredavid.fr/repo/departements.geojson'
-    departements_geojson = requests.get(geojson_url).json()
-
-    # Center the map on the average location of the clients
-    average_lat = data['lat'].mean()
-    average_lon = data['lng'].mean()
-    folium_map = folium.Map(location=[average_lat, average_lon], zoom_start=6)
-
-    # Add GeoJSON overlay for French departments
-    folium.GeoJson(
-        departements_geojson,
-        name="French Departments",
-        style_function=lambda x: {
-            "fillColor": "orange",
-            "color": "black",
-            "weight": 0.5,
-            "fillOpacity": 0.2,
-        },
-    ).add_to(folium_map)
-
-    # Add markers for each client
-    for _, row in data.iterrows():
-        popup_content = f"""
-        bName:/b {row['Name']}br
-        bAddress:/b {row['Address']}br
-        bDepartment:/b {row['AdministrativeArea2']}br
-        """
-        folium.Marker(
-            location=[row['lat'], row['lng']],
-            popup=popup_content,
-            icon=folium.Icon(color='darkgreen'),
-        ).add_to(folium_map)
-
-    # Save the map as an HTML file
-    map_filename = 'client_map.html'
-    folium_map.save(map_filename)
-
-    # Read and display the saved HTML map in the Streamlit app
-    with open(map_filename, 'r', encoding='utf-8') as file:
-        html_data = file.read()
+    # Clients the geocoder could not place fall back on their commune or department centroid;
+    # rows that cannot be placed at all are removed
+    data = locate_clients(data, coords, get_centroids(), get_department_geometry().codes_by_name)
 
-    st.download_button(
-        label="Download Map",
-        data=html_data,
-        file_name=map_filename,
-        mime="text/html",
+    # Connection reuse of the process-wide geocoder client and lookups saved by normalization
+    geocoder = get_geocoder(OPEN_CAGE_API_KEY)
+    stats = geocoder.stats()
+    st.sidebar.caption(
+        f"Géocodeur : {stats['requests']} requêtes, {stats['reused']} connexions réutilisées, "
+        f"{saved_lookups(data)} appels évités par normalisation"
     )
 
-    st.metric(label=f"Nombre de dispositifs en {selected_departments}", value=data.Name.unique().size)
+    # Daily budget left, as last reported by OpenCage
+    quota = geocoder.quota.snapshot()
+    if quota['remaining'] is not None:
+        st.sidebar.metric(
+            "Quota OpenCage du jour",
+            f"{quota['remaining']} / {quota['limit']}" if quota['limit'] else quota['remaining'],
+        )
+    if geocoder.breaker.is_open:
+        st.sidebar.warning("OpenCage indisponible : les nouvelles adresses sont placées approximativement.")
 
-    display_dataframe = st.toggle("Voir en détail")
-    columns_to_display = ['Name', 'Address', 'PostalCode', 'Locality', 'AdministrativeArea2']
-    if display_dataframe: 
-        st.dataframe(data[columns_to_display])
+    if data.empty:
+        st.warning("No valid geocoding results for the selected data.")
+        return
+
+    st.metric(label=f"Nombre de dispositifs en {selected_departments}", value=data.Name.unique().size)
+    approximate = int((data['Precision'] != 'exact').sum())
+    if approximate:
+        st.caption(f"{approximate} dispositifs placés approximativement (centre de la commune ou du département)")
 
-    st.components.v1.html(html_data, height=600, scrolling=True)
+    # The toggle and the map are fragments: interacting with one only reruns that section
+    show_details(data)
+    show_map(data, selected_departments)
 
 if __name__ == '__main__':
     main()
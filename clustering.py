@@ -0,0 +1,144 @@
+import math
+import threading
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+
+def project(lat, lng):
+    """
+    Project coordinates to normalized web-mercator space.
+
+    Parameters:
+        lat (array-like): Latitudes in degrees.
+        lng (array-like): Longitudes in degrees.
+
+    Returns:
+        tuple: (x, y) arrays in [0, 1], y growing southwards like tile rows.
+    """
+    lat = np.clip(np.asarray(lat, dtype=float), -85.0511, 85.0511)
+    x = (np.asarray(lng, dtype=float) + 180.0) / 360.0
+    y = 0.5 - np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) / (2 * np.pi)
+    return x, y
+
+
+class ClusterIndex:
+    """
+    Hierarchical grid clustering of client points, precomputed for every zoom level.
+
+    At each zoom the world is cut into square cells of cell_size screen pixels;
+    each cell holds the number of points in it and the sums needed for their
+    centroid. Cells are computed once at max_zoom and rolled up to the coarser
+    levels, since a cell at zoom z is made of 2x2 cells at zoom z + 1.
+    """
+
+    def __init__(self, min_zoom=0, max_zoom=16, cell_size=64, detail_zoom=13):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.detail_zoom = detail_zoom
+        # Cells per axis at zoom 0, a power of two so the levels nest
+        self.base_cells = 256 // cell_size
+        self.points = pd.DataFrame(columns=['key', 'lat', 'lng', 'x', 'y'])
+        self.levels = {}
+        self._rows = Counter()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.points)
+
+    def _aggregate(self, points):
+        """Aggregate points into cells at every zoom level."""
+        scale = self.base_cells * 2 ** self.max_zoom
+        cells = pd.DataFrame({
+            'cx': np.floor(points['x'].to_numpy(dtype=float) * scale).astype(np.int64),
+            'cy': np.floor(points['y'].to_numpy(dtype=float) * scale).astype(np.int64),
+            'count': 1,
+            'lat': points['lat'].to_numpy(dtype=float),
+            'lng': points['lng'].to_numpy(dtype=float),
+        })
+        levels = {}
+        for zoom in range(self.max_zoom, self.min_zoom - 1, -1):
+            cells = cells.groupby(['cx', 'cy']).sum()
+            levels[zoom] = cells
+            cells = cells.reset_index()
+            cells['cx'] //= 2
+            cells['cy'] //= 2
+        return levels
+
+    def update(self, data, key='Name'):
+        """
+        Bring the index in line with a client DataFrame.
+
+        Points are identified by their (key, lat, lng) triple, counted once per
+        row. New points are aggregated and added to the existing cells; when
+        points were removed or moved, the index is rebuilt from scratch.
+
+        Parameters:
+            data (DataFrame): Geocoded clients with 'lat' and 'lng' columns.
+            key (str): Column identifying a client.
+
+        Returns:
+            int: The number of points added.
+        """
+        rows = Counter(zip(data[key].tolist(), data['lat'].tolist(), data['lng'].tolist()))
+        with self._lock:
+            if self._rows - rows:
+                self.points = self.points.iloc[0:0]
+                self.levels = {}
+                self._rows = Counter()
+            added = rows - self._rows
+            if not added:
+                return 0
+            self._rows = rows
+            added = pd.DataFrame(list(added.elements()), columns=['key', 'lat', 'lng'])
+            added = added.assign(**dict(zip(('x', 'y'), project(added['lat'], added['lng']))))
+            new_levels = self._aggregate(added)
+            self.levels = {
+                zoom: cells.add(self.levels[zoom], fill_value=0) if zoom in self.levels else cells
+                for zoom, cells in new_levels.items()
+            }
+            self.points = pd.concat([self.points, added], ignore_index=True) if len(self.points) else added
+            return len(added)
+
+    def _cell_range(self, zoom, bounds):
+        scale = self.base_cells * 2 ** zoom
+        (south, west), (north, east) = bounds
+        (x0, x1), (y1, y0) = project([south, north], [west, east])
+        return (math.floor(x0 * scale), math.floor(x1 * scale),
+                math.floor(y0 * scale), math.floor(y1 * scale))
+
+    def clusters(self, zoom, bounds=None):
+        """
+        Return the cluster centroids at a zoom level.
+
+        Parameters:
+            zoom (int): The map zoom level.
+            bounds (list): Optional [[south, west], [north, east]] view to restrict to.
+
+        Returns:
+            DataFrame: 'lat', 'lng' (centroid) and 'count' of every non-empty cell.
+        """
+        zoom = max(self.min_zoom, min(self.max_zoom, int(zoom)))
+        with self._lock:
+            cells = self.levels.get(zoom)
+        if cells is None:
+            return pd.DataFrame(columns=['lat', 'lng', 'count'])
+        if bounds is not None:
+            x0, x1, y0, y1 = self._cell_range(zoom, bounds)
+            cx = cells.index.get_level_values('cx')
+            cy = cells.index.get_level_values('cy')
+            cells = cells[(cx >= x0) & (cx <= x1) & (cy >= y0) & (cy <= y1)]
+        return pd.DataFrame({
+            'lat': cells['lat'] / cells['count'],
+            'lng': cells['lng'] / cells['count'],
+            'count': cells['count'].astype(int),
+        }).reset_index(drop=True)
+
+    def keys_in(self, bounds):
+        """Return the keys of the individual clients inside a view."""
+        (south, west), (north, east) = bounds
+        with self._lock:
+            points = self.points
+        inside = points['lat'].between(south, north) & points['lng'].between(west, east)
+        return points.loc[inside, 'key']
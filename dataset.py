@@ -0,0 +1,260 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import requests
+
+from addresses import normalize_addresses
+
+CLIENTS_CSV_URL = "http://metabase.prod.tessan.cloud/public/question/6c3c45ab-7379-4815-8941-dcd6763c555c.csv"
+
+# How often the export is revalidated against Metabase, in seconds
+CLIENTS_REFRESH_INTERVAL = float(os.environ.get("CLIENTS_REFRESH_INTERVAL", "3600"))
+CLIENTS_TIMEOUT = float(os.environ.get("CLIENTS_TIMEOUT", "60"))
+
+# Columns used by the app and how to store them: low-cardinality fields as categoricals
+CLIENT_SCHEMA = {
+    'Name': 'string',
+    'Address': 'string',
+    'PostalCode': 'string',
+    'Locality': 'category',
+    'AdministrativeArea2': 'category',
+}
+
+
+def read_clients(source=CLIENTS_CSV_URL):
+    """
+    Read the client export, parsing only the columns the app uses.
+
+    Parameters:
+        source (str or file-like): URL, path or buffer of the CSV export.
+
+    Returns:
+        DataFrame: The clients, typed according to CLIENT_SCHEMA, plus the
+                   canonical geocoding 'Query' of their address.
+    """
+    clients = pd.read_csv(source, usecols=list(CLIENT_SCHEMA), dtype=CLIENT_SCHEMA)
+    # Postal codes as fixed-width strings, restoring leading zeros lost by the export
+    clients['PostalCode'] = (
+        clients['PostalCode'].str.strip().str.replace(r'\.0$', '', regex=True).str.zfill(5)
+    )
+    clients['Query'] = normalize_addresses(clients)
+    return clients
+
+
+class ClientSource:
+    """
+    Client export kept fresh with conditional HTTP requests.
+
+    The export is revalidated at most once per refresh interval using its
+    ETag and Last-Modified validators, and only re-parsed when its content
+    actually changed. If Metabase cannot be reached the last frame is kept.
+    """
+
+    def __init__(self, url=CLIENTS_CSV_URL, refresh_interval=CLIENTS_REFRESH_INTERVAL,
+                 timeout=CLIENTS_TIMEOUT):
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.etag = None
+        self.last_modified = None
+        self.version = None
+        self.frame = None
+        self.checked_at = 0.0
+        self._lock = threading.RLock()
+
+    def refresh(self):
+        """
+        Revalidate the export and re-parse it if it changed.
+
+        Returns:
+            bool: True if a new frame was loaded.
+        """
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        response = self.session.get(self.url, headers=headers, timeout=self.timeout)
+        self.checked_at = time.time()
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+
+        # Servers without validators still resend identical content: compare it
+        version = hashlib.sha256(response.content).hexdigest()
+        if version == self.version:
+            return False
+        self.frame = read_clients(io.BytesIO(response.content))
+        self.version = version
+        return True
+
+    def get(self):
+        """
+        Return the current client frame, revalidating it when the interval has elapsed.
+
+        Returns:
+            DataFrame: The clients.
+        """
+        with self._lock:
+            if self.frame is None or time.time() - self.checked_at >= self.refresh_interval:
+                try:
+                    self.refresh()
+                except (requests.RequestException, ValueError):
+                    if self.frame is None:
+                        raise
+                    # Keep serving the last export until Metabase answers again
+                    self.checked_at = time.time()
+            return self.frame
+
+
+class DepartmentIndex:
+    """
+    Row positions of the clients of every department, built once per export.
+
+    Selecting departments is then a dictionary lookup and a concatenation
+    instead of a scan of the whole frame.
+
+    Parameters:
+        clients (DataFrame): The clients.
+        column (str): The department column.
+    """
+
+    def __init__(self, clients, column='AdministrativeArea2'):
+        self.clients = clients
+        # Rows without an address can never be placed on the map
+        usable = np.flatnonzero(clients['Address'].notna().to_numpy())
+        departments = clients[column].iloc[usable].reset_index(drop=True)
+        groups = departments.groupby(departments, observed=True, sort=True).indices
+        self.rows = {name: usable[positions] for name, positions in groups.items()}
+        self.options = sorted(self.rows)
+
+    def select(self, departments):
+        """Return the clients with an address in the given departments, in export order."""
+        positions = [self.rows[name] for name in departments if name in self.rows]
+        if not positions:
+            return self.clients.iloc[0:0]
+        return self.clients.iloc[np.sort(np.concatenate(positions))]
+
+
+# An immutable view of the clients, their department index and coordinates, swapped in as a whole
+ClientSnapshot = namedtuple('ClientSnapshot', ['version', 'clients', 'departments', 'coords', 'created_at'])
+
+EMPTY_COORDS = pd.DataFrame(columns=['lat', 'lng'], dtype=float, index=pd.Index([], name='Query'))
+
+class SnapshotRefresher:
+    """
+    Background thread keeping a ready client snapshot off the request path.
+
+    Every refresh interval the export is revalidated. Coordinates are keyed by
+    normalized address, so those of addresses still in the export are carried
+    forward and only addresses without coordinates are geocoded: new or edited
+    addresses, and those whose lookup failed before, which are retried even
+    when the export did not change. The new snapshot replaces the
+    current one in a single assignment, so readers always see clients and
+    coordinates that belong together. Only the very first load happens while a reader waits,
+    and it is published before its geocoding so the app is usable right away.
+
+    Parameters:
+        source (ClientSource): The client export.
+        geocode (callable): Maps an iterable of addresses to a 'lat'/'lng' frame
+            indexed by address, leaving out the addresses that failed.
+        interval (float): Seconds between two revalidations.
+    """
+
+    def __init__(self, source, geocode=None, interval=CLIENTS_REFRESH_INTERVAL):
+        self.source = source
+        self.geocode = geocode
+        self.interval = interval
+        self.last_error = None
+        self.last_refresh = None
+        self._snapshot = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def snapshot(self, timeout=None):
+        """Return the current snapshot, waiting for the first one if needed."""
+        if not self._ready.wait(timeout):
+            raise TimeoutError("No client snapshot available yet")
+        if self._snapshot is None:
+            raise self.last_error
+        return self._snapshot
+
+    def _publish(self, clients, coords):
+        current = self._snapshot
+        if current is not None and current.clients is clients:
+            departments = current.departments
+        else:
+            departments = DepartmentIndex(clients)
+        self._snapshot = ClientSnapshot(self.source.version, clients, departments, coords, time.time())
+        self._ready.set()
+
+    def refresh_once(self):
+        """
+        Revalidate the export and swap in a new snapshot if anything changed.
+
+        Returns:
+            bool: True if a new snapshot was published.
+        """
+        previous = self._snapshot
+        changed = self.source.refresh() or previous is None
+        clients = self.source.frame
+        addresses = clients['Query'].dropna().unique()
+        if previous is None:
+            self._publish(clients, EMPTY_COORDS)
+            carried = EMPTY_COORDS
+        else:
+            # Addresses the geocoder could not place are asked again: the geocode store
+            # skips them cheaply until their negative cache entry expires
+            carried = previous.coords[previous.coords.index.isin(addresses) & previous.coords['lat'].notna()]
+
+        # Addresses without coordinates: new or edited ones, earlier failures and misses
+        queue = set(addresses).difference(carried.index)
+        self.last_refresh = {'addresses': len(addresses), 'carried': len(carried), 'geocoded': len(queue)}
+        if not changed and not (queue and self.geocode is not None):
+            return False
+        coords = carried
+        if queue and self.geocode is not None:
+            found = self.geocode(sorted(queue))
+            if not changed and found['lat'].isna().all():
+                # Nothing new was placed: keep the current snapshot
+                return False
+            coords = pd.concat([carried, found])
+        self._publish(clients, coords)
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh_once()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e
+                # Unblock readers waiting on a first load that failed
+                self._ready.set()
+            # Retry a failed first load sooner than a regular revalidation
+            self._stop.wait(self.interval if self._snapshot is not None else min(self.interval, 30))
+
+    def start(self):
+        """Start the background refresh thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="client-refresher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Ask the background thread to stop after its current refresh."""
+        self._stop.set()
@@ -0,0 +1,162 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+# Location of the on-disk geocode store, shared by every app process on the host
+GEOCODE_CACHE_PATH = os.environ.get(
+    "GEOCODE_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "geocodes.sqlite"),
+)
+
+# How long an address the geocoder could not place is skipped before being tried again
+GEOCODE_MISS_TTL = float(os.environ.get("GEOCODE_MISS_TTL", str(30 * 24 * 3600)))  # seconds
+
+# Reasons recorded with a miss
+MISS_NOT_FOUND = "not_found"  # the geocoder answered with no result
+MISS_INVALID = "invalid"  # the geocoder rejected the query itself
+
+
+def cache_key(address):
+    """
+    Build the store key for an address.
+
+    Parameters:
+        address (str): The raw address.
+
+    Returns:
+        str: The address, NFC-normalized, lower-cased and with collapsed whitespace.
+    """
+    address = unicodedata.normalize("NFC", str(address))
+    return re.sub(r"\s+", " ", address).strip().casefold()
+
+
+class GeocodeStore:
+    """
+    Persistent geocode cache backed by SQLite.
+
+    Coordinates are kept in the 'geocodes' table; addresses the geocoder
+    could not place are kept apart in the 'misses' table with a reason and
+    an expiry, so they are skipped for a while instead of looked up again.
+
+    The database runs in WAL mode so several processes can read while one
+    writes; each thread gets its own connection.
+    """
+
+    def __init__(self, path=GEOCODE_CACHE_PATH, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS geocodes (
+                    address TEXT PRIMARY KEY,
+                    lat REAL NOT NULL,
+                    lng REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS misses (
+                    address TEXT PRIMARY KEY,
+                    reason TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, address):
+        """Return the stored (lat, lng) for an address, or None on a miss."""
+        row = self._connect().execute(
+            "SELECT lat, lng FROM geocodes WHERE address = ?", (cache_key(address),)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def _select_many(self, addresses, query, params=()):
+        """Run a SELECT whose first column is the key, mapping each address to the other columns."""
+        keys = {}
+        for address in addresses:
+            keys.setdefault(cache_key(address), []).append(address)
+        found = {}
+        conn = self._connect()
+        items = list(keys)
+        # Stay well below SQLite's host parameter limit
+        for start in range(0, len(items), 500):
+            chunk = items[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for key, *values in conn.execute(query.format(placeholders=placeholders), chunk + list(params)):
+                for address in keys[key]:
+                    found[address] = tuple(values)
+        return found
+
+    def get_many(self, addresses):
+        """Return a dict mapping each stored address to its (lat, lng)."""
+        return self._select_many(
+            addresses, "SELECT address, lat, lng FROM geocodes WHERE address IN ({placeholders})"
+        )
+
+    def get_misses(self, addresses):
+        """Return a dict mapping each address with an unexpired miss to its reason."""
+        found = self._select_many(
+            addresses,
+            "SELECT address, reason FROM misses WHERE address IN ({placeholders}) AND expires_at > ?",
+            (time.time(),),
+        )
+        return {address: reason for address, (reason,) in found.items()}
+
+    def put_misses(self, records, ttl=GEOCODE_MISS_TTL):
+        """
+        Record addresses the geocoder could not place, dropping the expired ones.
+
+        Parameters:
+            records (iterable): (address, reason) pairs, reason being MISS_NOT_FOUND or MISS_INVALID.
+            ttl (float): Seconds during which the addresses are skipped.
+        """
+        now = time.time()
+        rows = [(cache_key(address), reason, now + ttl, now) for address, reason in records]
+        if not rows:
+            return
+        with self._connect() as conn:
+            conn.execute("DELETE FROM misses WHERE expires_at <= ?", (now,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO misses (address, reason, expires_at, updated_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    def put(self, address, lat, lng):
+        """Store the coordinates of an address."""
+        self.put_many([(address, lat, lng)])
+
+    def put_many(self, records):
+        """Store an iterable of (address, lat, lng) records in one transaction, clearing their misses."""
+        now = time.time()
+        rows = [(cache_key(address), lat, lng, now) for address, lat, lng in records]
+        if not rows:
+            return
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO geocodes (address, lat, lng, updated_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            conn.executemany("DELETE FROM misses WHERE address = ?", [row[:1] for row in rows])
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM geocodes").fetchone()[0]
@@ -0,0 +1,476 @@
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from geocache import MISS_INVALID, MISS_NOT_FOUND
+from opencage.geocoder import (
+    ForbiddenError,
+    InvalidInputError,
+    NotAuthorizedError,
+    RateLimitExceededError,
+    UnknownError,
+)
+
+OPENCAGE_URL = "https://api.opencagedata.com/geocode/v1/json"
+
+# Bounded concurrency for batch geocoding, and the request rate shared by every caller
+GEOCODE_MAX_WORKERS = int(os.environ.get("GEOCODE_MAX_WORKERS", "8"))
+GEOCODE_RATE_LIMIT = float(os.environ.get("GEOCODE_RATE_LIMIT", "10"))  # requests per second
+GEOCODE_BURST = int(os.environ.get("GEOCODE_BURST", "1"))  # requests allowed back to back
+GEOCODE_TIMEOUT = float(os.environ.get("GEOCODE_TIMEOUT", "10"))  # seconds
+GEOCODE_THROTTLE_RETRIES = int(os.environ.get("GEOCODE_THROTTLE_RETRIES", "5"))  # 429 answers waited out per request
+
+# Transient failures are retried with exponential backoff; after enough of them in a
+# row the circuit opens and lookups fail fast until the cooldown has passed
+GEOCODE_RETRIES = int(os.environ.get("GEOCODE_RETRIES", "3"))
+GEOCODE_BACKOFF = float(os.environ.get("GEOCODE_BACKOFF", "0.5"))  # seconds, doubled per attempt
+GEOCODE_BACKOFF_MAX = float(os.environ.get("GEOCODE_BACKOFF_MAX", "8"))  # seconds
+GEOCODE_BREAKER_THRESHOLD = int(os.environ.get("GEOCODE_BREAKER_THRESHOLD", "5"))
+GEOCODE_BREAKER_COOLDOWN = float(os.environ.get("GEOCODE_BREAKER_COOLDOWN", "60"))  # seconds
+
+
+class GeocoderUnavailable(UnknownError):
+    """OpenCage could not answer right now: server error, garbled response or open circuit."""
+
+
+# Failures worth retrying in the same lookup
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout, GeocoderUnavailable)
+
+# Failures that say nothing about the address itself and must never be cached as an answer
+TRANSIENT_ERRORS = RETRYABLE_ERRORS + (RateLimitExceededError,)
+
+
+def is_transient(error):
+    """Return True if a lookup error may go away on its own, so the lookup should be tried later."""
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def retry_after(value, default=1.0):
+    """
+    Parse a Retry-After header, given in seconds or as an HTTP date.
+
+    Parameters:
+        value (str): The header value, None if it is missing.
+        default (float): Seconds to wait when the value cannot be parsed.
+
+    Returns:
+        float: Seconds to wait, never negative.
+    """
+    if value is None:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        return max(0.0, seconds) if math.isfinite(seconds) else default
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing service after threshold consecutive failures.
+
+    Once open, calls are refused until cooldown seconds have passed; then a
+    single trial call is let through, closing the circuit again on success.
+    """
+
+    TRIAL = "trial"
+
+    def __init__(self, threshold=GEOCODE_BREAKER_THRESHOLD, cooldown=GEOCODE_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None
+
+    def allow(self):
+        """
+        Return whether a call may be made now.
+
+        Returns:
+            bool or str: False if the circuit refuses the call, TRIAL if it is the
+                         trial call, which must be ended with release(), else True.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self._trial = True
+            return self.TRIAL
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """End the trial call however it went, so the next one may be let through."""
+        with self._lock:
+            self._trial = False
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: up to capacity calls at once, refilled at rate per second.
+
+    Callers over the limit wait for a token instead of failing, so every
+    thread sharing one bucket stays under the rate together.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate if rate and rate > 0 else 0.0
+        self.capacity = max(1.0, float(capacity))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Hold every caller back for some seconds, e.g. after the server throttled us."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+class DailyQuota:
+    """
+    Remaining OpenCage requests of the day, as reported by the API itself.
+
+    Every response of a metered account carries a 'rate' object with the
+    daily 'limit', the 'remaining' requests and the 'reset' UNIX time.
+    """
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self._lock = threading.Lock()
+
+    def update(self, rate):
+        """Record the 'rate' object of a response."""
+        if not rate:
+            return
+        with self._lock:
+            self.limit = rate.get('limit', self.limit)
+            self.remaining = rate.get('remaining', self.remaining)
+            self.reset = rate.get('reset', self.reset)
+
+    def exhaust(self, rate=None):
+        """
+        Record that the server refused a request for lack of quota.
+
+        Parameters:
+            rate (dict): The 'rate' object of the refusal, if it carried one. Without
+                         a known reset time the quota is assumed to reset at the next
+                         UTC midnight, when OpenCage resets daily quotas.
+        """
+        self.update(rate)
+        with self._lock:
+            self.remaining = 0
+            if self.reset is None or self.reset <= time.time():
+                self.reset = (int(time.time()) // 86400 + 1) * 86400
+
+    def exhausted(self):
+        """Return True while no request is left before the next reset."""
+        with self._lock:
+            if self.remaining is None or self.remaining > 0:
+                return False
+            if self.reset is not None and time.time() >= self.reset:
+                # A new day started: let the next response tell the new budget
+                self.remaining = None
+                return False
+            return True
+
+    def snapshot(self):
+        """Return the 'limit', 'remaining' and 'reset' last reported, None if unknown."""
+        with self._lock:
+            return {'limit': self.limit, 'remaining': self.remaining, 'reset': self.reset}
+
+
+class GeocoderClient:
+    """
+    OpenCage client keeping a pool of keep-alive connections.
+
+    One instance is meant to be shared by every thread of a process so that
+    lookups reuse open TLS connections instead of paying a handshake each,
+    and so that all of them draw from one rate limiter, one daily quota and
+    one circuit breaker. Concurrent requests for the same query share a
+    single API call.
+    """
+
+    def __init__(self, api_key, pool_size=GEOCODE_MAX_WORKERS, timeout=GEOCODE_TIMEOUT,
+                 rate_limit=GEOCODE_RATE_LIMIT, burst=GEOCODE_BURST, retries=GEOCODE_RETRIES,
+                 backoff=GEOCODE_BACKOFF, throttle_retries=GEOCODE_THROTTLE_RETRIES):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.throttle_retries = throttle_retries
+        self.limiter = TokenBucket(rate_limit, burst)
+        self.quota = DailyQuota()
+        self.breaker = CircuitBreaker()
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = "tessan-clients-map"
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._in_flight = {}
+
+    def geocode(self, query, **params):
+        """
+        Send a forward geocoding request.
+
+        Parameters:
+            query (str): The address to geocode.
+            **params: Extra OpenCage API parameters.
+
+        Returns:
+            dict: The full JSON response of the API.
+
+        Raises:
+            NotAuthorizedError, ForbiddenError, RateLimitExceededError, InvalidInputError,
+            UnknownError, GeocoderUnavailable, requests.ConnectionError, requests.Timeout
+        """
+        key = (query, tuple(sorted(params.items())))
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            body = self._send_with_retries(query, params)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(body)
+            return body
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def _send_with_retries(self, query, params):
+        """Send a request, retrying transient failures with jittered exponential backoff."""
+        for attempt in range(self.retries + 1):
+            if self.quota.exhausted():
+                raise RateLimitExceededError()
+            allowed = self.breaker.allow()
+            if not allowed:
+                raise GeocoderUnavailable("OpenCage circuit open after repeated failures")
+            try:
+                body = self._send(query, params)
+            except RETRYABLE_ERRORS:
+                self.breaker.record_failure()
+                if attempt == self.retries:
+                    raise
+            except Exception:
+                # Any other answer (rejected query, quota, credentials) proves the service is up
+                self.breaker.record_success()
+                raise
+            else:
+                self.breaker.record_success()
+                return body
+            finally:
+                # Only the trial call ends the trial; calls started before the circuit opened do not
+                if allowed == CircuitBreaker.TRIAL:
+                    self.breaker.release()
+            time.sleep(random.uniform(0, min(GEOCODE_BACKOFF_MAX, self.backoff * 2 ** attempt)))
+
+    def _send(self, query, params):
+        """Send one request once the limiter allows it, waiting out a bounded amount of server throttling."""
+        throttled = 0
+        while True:
+            if self.quota.exhausted():
+                raise RateLimitExceededError()
+            self.limiter.acquire()
+            with self._lock:
+                self._requests += 1
+            response = self.session.get(
+                OPENCAGE_URL,
+                params={"q": query, "key": self.api_key, **params},
+                timeout=self.timeout,
+            )
+            if response.status_code == 429:
+                throttled += 1
+                if throttled > self.throttle_retries:
+                    raise RateLimitExceededError()
+                # Too many requests per second: slow every caller down and queue again
+                self.limiter.pause(retry_after(response.headers.get("Retry-After")))
+                continue
+            break
+        if response.status_code == 400:
+            raise InvalidInputError("Query rejected by the geocoder", bad_value=query)
+        if response.status_code == 401:
+            raise NotAuthorizedError()
+        if response.status_code == 403:
+            raise ForbiddenError()
+        if response.status_code == 402:
+            try:
+                rate = response.json().get("rate")
+            except (ValueError, AttributeError):
+                rate = None
+            self.quota.exhaust(rate)
+            raise RateLimitExceededError()
+        if response.status_code == 408 or response.status_code >= 500:
+            raise GeocoderUnavailable(f"{response.status_code} status code from API")
+        # Error bodies carry an empty result list too: only a 200 answers the query
+        if response.status_code != 200:
+            raise UnknownError(f"{response.status_code} status code from API")
+        try:
+            body = response.json()
+        except ValueError as e:
+            raise GeocoderUnavailable("Non-JSON result from server") from e
+        if "results" not in body:
+            raise UnknownError(f"{response.status_code} status code from API")
+        self.quota.update(body.get("rate"))
+        return body
+
+    def stats(self):
+        """
+        Report connection reuse since the client was created.
+
+        Returns:
+            dict: 'requests' sent, 'connections' opened and 'reused' connections.
+        """
+        pools = self.session.get_adapter(OPENCAGE_URL).poolmanager.pools
+        connections = sum(pools[key].num_connections for key in pools.keys())
+        with self._lock:
+            sent = self._requests
+        return {
+            "requests": sent,
+            "connections": connections,
+            "reused": max(sent - connections, 0),
+        }
+
+
+def get_geocode(query, client):
+    """
+    Get latitude and longitude for a given address using the OpenCage API.
+
+    Parameters:
+        query (str): The address to geocode.
+        client (GeocoderClient): The shared OpenCage client.
+
+    Returns:
+        tuple: (latitude, longitude) or (None, None) if not found.
+
+    Raises:
+        Exception: Any error raised by the OpenCage client.
+    """
+    result = client.geocode(query)["results"]
+    if result and len(result) > 0:
+        return result[0]['geometry']['lat'], result[0]['geometry']['lng']
+    return None, None
+
+
+def geocode_batch(addresses, geocode, store=None, max_workers=GEOCODE_MAX_WORKERS, local=None):
+    """
+    Geocode a collection of addresses, resolving each distinct address once.
+
+    Addresses found in the store are served from it, and those it records as
+    recent misses are skipped; the others are matched against the local
+    address reference first, and only the remaining ones are resolved with
+    bounded concurrency. Every new coordinate is written back to the store,
+    and every address the geocoder answered for without placing it (a 200
+    with no result) is recorded as a miss, as is every query it rejected.
+    Other failures are not recorded.
+
+    Parameters:
+        addresses (iterable): Addresses to geocode, duplicates allowed.
+        geocode (callable): Single-address lookup returning (lat, lng), rate limited
+                            by the shared GeocoderClient it calls.
+        store (GeocodeStore): Optional persistent store to read from and write to.
+        max_workers (int): Maximum number of concurrent lookups.
+        local (callable): Optional bulk lookup returning a dict of address -> (lat, lng)
+                          for the addresses it can resolve offline.
+
+    Returns:
+        tuple: (DataFrame indexed by address with 'lat' and 'lng' columns,
+                dict mapping each failed address to its exception)
+    """
+    unique = pd.Series(list(addresses), dtype=object).dropna().unique().tolist()
+    coords = store.get_many(unique) if store is not None else {}
+    known_misses = store.get_misses(unique) if store is not None else {}
+    misses = [address for address in unique if address not in coords and address not in known_misses]
+
+    if local is not None and misses:
+        matched = local(misses)
+        coords.update(matched)
+        if store is not None:
+            store.put_many((address, lat, lng) for address, (lat, lng) in matched.items())
+        misses = [address for address in misses if address not in matched]
+
+    errors = {}
+
+    def resolve(address):
+        try:
+            return address, geocode(address)
+        except Exception as e:
+            errors[address] = e
+            return address, (None, None)
+
+    if misses:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(misses)))) as pool:
+            resolved = [(address, latlng) for address, latlng in pool.map(resolve, misses)
+                        if latlng[0] is not None]
+        coords.update(dict(resolved))
+        if store is not None:
+            store.put_many((address, lat, lng) for address, (lat, lng) in resolved)
+            store.put_misses(
+                [(address, MISS_NOT_FOUND) for address in misses if address not in coords and address not in errors]
+                + [(address, MISS_INVALID) for address, e in errors.items() if isinstance(e, InvalidInputError)]
+            )
+
+    frame = pd.DataFrame(
+        [coords.get(address, (None, None)) for address in unique],
+        index=pd.Index(unique, name='Query'),
+        columns=['lat', 'lng'],
+        dtype=float,
+    )
+    return frame, errors
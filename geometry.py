@@ -0,0 +1,339 @@
+import hashlib
+import json
+import math
+import os
+import re
+import unicodedata
+
+import requests
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# Bump the version, and its expected digest, to use a new release of the departments outlines
+DEPARTMENTS_GEOJSON_URL = 'https://france-geojson.gregoiredavid.fr/repo/departements.geojson'
+DEPARTMENTS_GEOJSON_VERSION = "v1"
+DEPARTMENTS_GEOJSON_SHA256 = "751f67d9bc9b8cf9fc3c574ee8af9caaf7493fb8e9ee5ed0ffd6ea6444ec1ed1"
+DEPARTMENTS_GEOJSON_PATH = os.path.join(DATA_DIR, f"departements-{DEPARTMENTS_GEOJSON_VERSION}.geojson")
+
+
+def file_checksum(path):
+    """Return the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fetch_departments_geojson(path=DEPARTMENTS_GEOJSON_PATH, url=DEPARTMENTS_GEOJSON_URL,
+                              checksum=DEPARTMENTS_GEOJSON_SHA256, timeout=30):
+    """
+    Download the departments GeoJSON to a local file, checking it is the pinned release.
+
+    The file is written atomically so concurrent processes never read a
+    partial download.
+
+    Parameters:
+        path (str): Destination file.
+        url (str): Source URL.
+        checksum (str): Expected SHA-256 hex digest of the file.
+        timeout (float): HTTP timeout in seconds.
+
+    Raises:
+        ValueError: The downloaded file is not the pinned release; the local file is left untouched.
+    """
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    digest = hashlib.sha256(response.content).hexdigest()
+    if digest != checksum:
+        raise ValueError(
+            f"{url} now serves a file with SHA-256 {digest}, not the {DEPARTMENTS_GEOJSON_VERSION} "
+            f"release {checksum}: restore {path} or bump DEPARTMENTS_GEOJSON_VERSION and its digest"
+        )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(response.content)
+    os.replace(tmp_path, path)
+
+
+def load_departments_geojson(path=DEPARTMENTS_GEOJSON_PATH, checksum=DEPARTMENTS_GEOJSON_SHA256):
+    """
+    Load the French departments GeoJSON from its versioned local file.
+
+    The file is only downloaded when it is missing or does not match the
+    digest pinned for its version, so the app runs fully offline once it is
+    in place and the outlines never change under a fixed version name.
+
+    Parameters:
+        path (str): The versioned local file.
+        checksum (str): Expected SHA-256 hex digest of the file.
+
+    Returns:
+        dict: The departments FeatureCollection.
+    """
+    if not os.path.exists(path) or file_checksum(path) != checksum:
+        fetch_departments_geojson(path, checksum=checksum)
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+# =============================================================================
+# Simplified, department-scoped outlines
+# =============================================================================
+
+# Map zoom level -> simplification tolerance in degrees (about half a pixel at that zoom)
+SIMPLIFY_TOLERANCES = {6: 0.01, 8: 0.0025, 10: 0.0006}
+
+
+def name_key(name):
+    """Normalize a department name for matching ('Côte-d'Or' -> 'cote d or')."""
+    name = unicodedata.normalize('NFKD', str(name))
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', name.casefold()).split())
+
+
+def department_codes_by_name(geojson):
+    """Map the normalized name of every department of a GeoJSON to its code."""
+    return {
+        name_key(feature['properties']['nom']): feature['properties']['code']
+        for feature in geojson['features']
+    }
+
+
+def department_code(postal_code):
+    """Return the department code of a French postal code, or None."""
+    if isinstance(postal_code, float):
+        postal_code = int(postal_code)
+    postal_code = str(postal_code).strip().zfill(5)
+    if not postal_code[:2].isdigit():
+        return None
+    if postal_code.startswith('20'):
+        return '2A' if postal_code[:3] in ('200', '201') else '2B'
+    if postal_code.startswith('97'):
+        return postal_code[:3]
+    return postal_code[:2]
+
+
+def zoom_for_bounds(bounds, width=900, height=600):
+    """
+    Return the largest web-mercator zoom level fitting bounds in a viewport.
+
+    Parameters:
+        bounds (list): [[south, west], [north, east]] in degrees.
+        width (int): Viewport width in pixels.
+        height (int): Viewport height in pixels.
+
+    Returns:
+        int: The zoom level, between 2 and 18.
+    """
+    (south, west), (north, east) = bounds
+
+    def mercator_y(lat):
+        return math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+
+    lng_span = max(east - west, 1e-6)
+    y_span = max(mercator_y(north) - mercator_y(south), 1e-6)
+    zoom_x = math.log2(width * 360 / (256 * lng_span))
+    zoom_y = math.log2(height * 2 * math.pi / (256 * y_span))
+    return int(max(2, min(18, math.floor(min(zoom_x, zoom_y)))))
+
+
+def _simplify_line(points, tolerance):
+    """Douglas-Peucker simplification keeping both end points."""
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first], points[last]
+        dx, dy = x2 - x1, y2 - y1
+        norm = math.hypot(dx, dy)
+        max_distance, index = 0.0, None
+        for i in range(first + 1, last):
+            x, y = points[i]
+            if norm:
+                distance = abs(dy * (x - x1) - dx * (y - y1)) / norm
+            else:
+                distance = math.hypot(x - x1, y - y1)
+            if distance > max_distance:
+                max_distance, index = distance, i
+        if index is not None and max_distance > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _polygons(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    return geometry['coordinates']
+
+
+class DepartmentGeometry:
+    """
+    French department outlines precomputed at several simplification levels.
+
+    Rings are cut into arcs at the points where neighbouring departments meet,
+    and every arc is simplified once, so shared borders stay identical on
+    both sides and no gaps or overlaps appear between departments.
+    """
+
+    def __init__(self, geojson, tolerances=SIMPLIFY_TOLERANCES):
+        self.tolerances = dict(sorted(tolerances.items()))
+        features = geojson['features']
+        self.properties = {}
+        self.codes_by_name = department_codes_by_name(geojson)
+        self.bounds_by_code = {}
+
+        # Open rings as tuples of points, grouped by department and polygon
+        rings = []
+        layout = {}
+        for feature in features:
+            code = feature['properties']['code']
+            self.properties[code] = feature['properties']
+            layout[code] = []
+            for polygon in _polygons(feature['geometry']):
+                ring_ids = []
+                for ring in polygon:
+                    points = [tuple(point[:2]) for point in ring]
+                    if points[0] == points[-1]:
+                        points = points[:-1]
+                    ring_ids.append(len(rings))
+                    rings.append((code, points))
+                layout[code].append(ring_ids)
+            lngs = [p[0] for ring_id in sum(layout[code], []) for p in rings[ring_id][1]]
+            lats = [p[1] for ring_id in sum(layout[code], []) for p in rings[ring_id][1]]
+            self.bounds_by_code[code] = [[min(lats), min(lngs)], [max(lats), max(lngs)]]
+
+        # A point is a junction wherever the set of rings through it changes
+        members = {}
+        for ring_id, (_, points) in enumerate(rings):
+            for point in points:
+                members.setdefault(point, set()).add(ring_id)
+        junctions = set()
+        for _, points in rings:
+            count = len(points)
+            for i, point in enumerate(points):
+                shared = members[point]
+                if shared != members[points[i - 1]] or shared != members[points[(i + 1) % count]]:
+                    junctions.add(point)
+
+        # Cut every ring into arcs, deduplicating arcs shared by two rings
+        self.arcs = []
+        arc_ids = {}
+        arc_users = {}
+        self.ring_arcs = []
+        for code, points in rings:
+            cuts = [i for i, point in enumerate(points) if point in junctions] or [0]
+            refs = []
+            for n, start in enumerate(cuts):
+                end = cuts[(n + 1) % len(cuts)]
+                if end > start:
+                    arc = points[start:end + 1]
+                else:
+                    arc = points[start:] + points[:end + 1]
+                forward, backward = tuple(arc), tuple(reversed(arc))
+                key = min(forward, backward)
+                if key not in arc_ids:
+                    arc_ids[key] = len(self.arcs)
+                    self.arcs.append(key)
+                arc_id = arc_ids[key]
+                arc_users.setdefault(arc_id, set()).add(code)
+                refs.append((arc_id, key != forward))
+            self.ring_arcs.append((points, refs))
+        self.layout = layout
+
+        self.neighbours = {code: set() for code in layout}
+        for codes in arc_users.values():
+            for code in codes:
+                self.neighbours[code] |= codes - {code}
+
+        # Simplify every arc once per level, then rebuild the departments
+        self.levels = {}
+        for zoom, tolerance in self.tolerances.items():
+            digits = max(0, math.ceil(-math.log10(tolerance))) + 2
+            simplified = []
+            for arc in self.arcs:
+                line = [(round(x, digits), round(y, digits)) for x, y in _simplify_line(arc, tolerance)]
+                simplified.append([p for i, p in enumerate(line) if i == 0 or p != line[i - 1]])
+            self.levels[zoom] = {
+                code: self._build_feature(code, simplified, digits) for code in layout
+            }
+
+    def _build_ring(self, ring_id, simplified, digits):
+        points, refs = self.ring_arcs[ring_id]
+        ring = []
+        for arc_id, backward in refs:
+            line = simplified[arc_id][::-1] if backward else simplified[arc_id]
+            ring.extend(line[1:] if ring else line)
+        if ring[0] != ring[-1]:
+            ring.append(ring[0])
+        if len(ring) < 4:
+            # Too small to survive this level: keep it at full resolution
+            ring = [(round(x, digits), round(y, digits)) for x, y in points + [points[0]]]
+        return [list(point) for point in ring]
+
+    def _build_feature(self, code, simplified, digits):
+        polygons = [
+            [self._build_ring(ring_id, simplified, digits) for ring_id in ring_ids]
+            for ring_ids in self.layout[code]
+        ]
+        if len(polygons) == 1:
+            geometry = {'type': 'Polygon', 'coordinates': polygons[0]}
+        else:
+            geometry = {'type': 'MultiPolygon', 'coordinates': polygons}
+        return {'type': 'Feature', 'geometry': geometry, 'properties': self.properties[code]}
+
+    def codes_for(self, names=(), postal_codes=()):
+        """
+        Resolve department names, falling back on postal codes, to department codes.
+
+        Parameters:
+            names (iterable): Department names such as 'Côte-d'Or'.
+            postal_codes (iterable): Postal codes of the clients.
+
+        Returns:
+            set: The matching department codes.
+        """
+        codes = {self.codes_by_name.get(name_key(name)) for name in names}
+        codes |= {department_code(postal_code) for postal_code in postal_codes}
+        return {code for code in codes if code in self.layout}
+
+    def with_neighbours(self, codes):
+        """Return the codes together with every department bordering them."""
+        codes = set(codes)
+        return codes.union(*(self.neighbours[code] for code in codes))
+
+    def bounds(self, codes):
+        """Return the [[south, west], [north, east]] bounds of some departments."""
+        boxes = [self.bounds_by_code[code] for code in codes]
+        return [
+            [min(box[0][0] for box in boxes), min(box[0][1] for box in boxes)],
+            [max(box[1][0] for box in boxes), max(box[1][1] for box in boxes)],
+        ]
+
+    def level_for_zoom(self, zoom):
+        """Return the coarsest precomputed level that is still accurate at a zoom."""
+        eligible = [level for level in self.levels if level <= zoom]
+        return max(eligible) if eligible else min(self.levels)
+
+    def feature_collection(self, codes, zoom):
+        """
+        Build a FeatureCollection of some departments at a zoom-appropriate resolution.
+
+        Parameters:
+            codes (iterable): The department codes to embed.
+            zoom (int): The map zoom level the outlines will be viewed at.
+
+        Returns:
+            dict: The simplified FeatureCollection.
+        """
+        level = self.levels[self.level_for_zoom(zoom)]
+        return {
+            'type': 'FeatureCollection',
+            'features': [level[code] for code in sorted(codes) if code in level],
+        }
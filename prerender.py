@@ -0,0 +1,342 @@
+"""
+Pre-render the client maps of some departments, or of all of them, to HTML files.
+
+Runs the same load, geocode and render stages as the Streamlit app, without a
+browser session, so the maps can be built ahead of time (e.g. nightly by cron):
+
+    OPENCAGE_API_KEY=... python prerender.py --all --output-dir maps
+    python prerender.py Aisne "Côte-d'Or"
+
+Without OPENCAGE_API_KEY only the geocode store and the local address
+reference are used, and the other clients are placed at their centroid.
+Maps whose inputs did not change since the last build are kept as they are.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import folium
+import requests
+
+from centroids import load_centroids, locate_clients
+from dataset import CLIENTS_CSV_URL, ClientSource, DepartmentIndex, read_clients
+from geocache import GeocodeStore
+from geocoding import GeocoderClient, GeocoderUnavailable, geocode_batch, get_geocode, is_transient
+from geometry import (
+    DEPARTMENTS_GEOJSON_VERSION,
+    SIMPLIFY_TOLERANCES,
+    DepartmentGeometry,
+    department_codes_by_name,
+    load_departments_geojson,
+    name_key,
+)
+from reference import geocode_locally
+from rendering import (
+    MAP_RENDER_MODE,
+    POPUP_FIELDS,
+    build_department_map,
+    choose_mode,
+    data_version,
+    render_html,
+)
+
+logger = logging.getLogger("prerender")
+
+# Exit codes, for cron and monitoring
+EXIT_OK = 0
+EXIT_FAILED = 1  # some departments could not be rendered
+EXIT_USAGE = 2  # bad arguments or unknown department
+EXIT_NO_DATA = 3  # the client export could not be loaded
+EXIT_DEGRADED = 4  # every map was written, but some clients are only approximately placed after geocoding errors
+
+PRERENDER_OUTPUT_DIR = os.environ.get("PRERENDER_OUTPUT_DIR", "maps")
+PRERENDER_WORKERS = int(os.environ.get("PRERENDER_WORKERS", str(os.cpu_count() or 1)))
+MANIFEST_NAME = "manifest.json"
+
+
+def load_clients(source=CLIENTS_CSV_URL):
+    """Read the client export from a local file, or revalidate it from its URL."""
+    if os.path.exists(source):
+        return read_clients(source)
+    return ClientSource(source).get()
+
+
+def geocode_clients(clients, api_key=None, store=None):
+    """
+    Geocode the distinct queries of some clients, like the app does.
+
+    Parameters:
+        clients (DataFrame): Clients with a 'Query' column.
+        api_key (str): OpenCage API key, None to stay offline.
+        store (GeocodeStore): The persistent geocode store.
+
+    Returns:
+        tuple: ('lat'/'lng' DataFrame indexed by query, dict of failed queries)
+    """
+    if api_key:
+        geocoder = GeocoderClient(api_key)
+
+        def geocode(query):
+            return get_geocode(query, geocoder)
+    else:
+        def geocode(query):
+            raise GeocoderUnavailable("OPENCAGE_API_KEY is not set")
+
+    return geocode_batch(clients['Query'].dropna(), geocode, store=store, local=geocode_locally)
+
+
+def department_filename(department):
+    """Return the file name of a department's map ('Côte-d'Or' -> 'cote-d-or.html')."""
+    return name_key(department).replace(' ', '-') + '.html'
+
+
+def static_mode(count, mode=MAP_RENDER_MODE):
+    """
+    Resolve the client layer of a static map of count clients.
+
+    The 'server' mode needs a live session to follow the view, so static
+    maps cluster in the browser instead.
+    """
+    mode = choose_mode(count, mode)
+    return 'cluster' if mode == 'server' else mode
+
+
+def render_department(data, geometry, department, mode=MAP_RENDER_MODE):
+    """Render the map of one department's located clients to HTML."""
+    return render_html(build_department_map(data, geometry, [department], static_mode(len(data), mode)))
+
+
+def department_stamp(data, department, mode=MAP_RENDER_MODE):
+    """
+    Hash everything a department's map is built from.
+
+    Parameters:
+        data (DataFrame): The department's located clients.
+        department (str): The department name.
+        mode (str): The requested client layer.
+
+    Returns:
+        str: A digest of the rendered rows and coordinates, the resolved
+             client layer, the popup fields and the outline version.
+    """
+    settings = [
+        department,
+        static_mode(len(data), mode),
+        list(POPUP_FIELDS.items()),
+        DEPARTMENTS_GEOJSON_VERSION,
+        sorted(SIMPLIFY_TOLERANCES.items()),
+        folium.__version__,
+    ]
+    return hashlib.sha1((data_version(data) + json.dumps(settings)).encode('utf-8')).hexdigest()
+
+
+def write_atomic(path, content):
+    """Write bytes to a file so readers never see a partial map."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(content)
+    os.replace(tmp_path, path)
+
+
+# Located clients, their row positions per department and the outlines, set once per worker
+_shared = {}
+
+
+def _init_worker(located, rows, geometry, output_dir, mode):
+    _shared.update(located=located, rows=rows, geometry=geometry, output_dir=output_dir, mode=mode)
+
+
+def _render_one(department):
+    """Render and write one department's map in a worker; never raises."""
+    started = time.monotonic()
+    try:
+        data = _shared['located'].iloc[_shared['rows'].get(department, [])]
+        html = render_department(data, _shared['geometry'], department, _shared['mode']).encode('utf-8')
+        filename = department_filename(department)
+        write_atomic(os.path.join(_shared['output_dir'], filename), html)
+    except Exception:
+        return department, None, traceback.format_exc()
+    entry = {
+        'file': filename,
+        'clients': len(data),
+        'bytes': len(html),
+        'seconds': round(time.monotonic() - started, 3),
+    }
+    return department, entry, None
+
+
+def department_rows(located):
+    """Return the row positions of the located clients of every department."""
+    return located.reset_index(drop=True).groupby('AdministrativeArea2', observed=True).indices
+
+
+def render_departments(located, rows, geometry, departments, output_dir, mode=MAP_RENDER_MODE,
+                       workers=PRERENDER_WORKERS):
+    """
+    Render one map per department, fanned out over a process pool.
+
+    Workers are forked where the platform allows it, so they share the
+    located clients and the outlines of the parent copy-on-write instead of
+    receiving a pickled copy each.
+
+    Parameters:
+        located (DataFrame): Located clients of every department to render.
+        rows (dict): Row positions of each department's clients, from department_rows.
+        geometry (DepartmentGeometry): The precomputed department outlines.
+        departments (list): Department names.
+        output_dir (str): Directory of the HTML files.
+        mode (str): Client layer of the maps.
+        workers (int): Number of worker processes, 1 to render in this process.
+
+    Yields:
+        tuple: (department, manifest entry or None, error traceback or None).
+    """
+    initargs = (located, rows, geometry, output_dir, mode)
+    workers = max(1, min(workers, len(departments)))
+    if not departments:
+        return
+    if workers == 1:
+        _init_worker(*initargs)
+        yield from map(_render_one, departments)
+        return
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=initargs) as pool:
+        # Biggest departments first so a large one does not finish the build alone
+        order = sorted(departments, key=lambda department: -len(rows.get(department, ())))
+        yield from pool.map(_render_one, order)
+
+
+def read_manifest(output_dir):
+    """Return the department entries of the manifest of a previous build, {} if there is none."""
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME), 'r', encoding='utf-8') as file:
+            return json.load(file).get('departments', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def is_current(entry, stamp, output_dir):
+    """Return True if a manifest entry matches a stamp and its file is still there."""
+    return (
+        entry is not None
+        and entry.get('stamp') == stamp
+        and os.path.exists(os.path.join(output_dir, entry['file']))
+    )
+
+
+def write_manifest(output_dir, entries, rebuilt, errors, mode):
+    """Write the manifest describing every map of the output directory."""
+    manifest = {
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'mode': mode,
+        'rebuilt': sorted(rebuilt),
+        'departments': dict(sorted(entries.items())),
+        'errors': dict(sorted(errors.items())),
+    }
+    write_atomic(
+        os.path.join(output_dir, MANIFEST_NAME),
+        json.dumps(manifest, indent=2, ensure_ascii=False).encode('utf-8'),
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-render the client maps of French departments.")
+    parser.add_argument('departments', nargs='*', help="department names as in the export, e.g. 'Aisne'")
+    parser.add_argument('--all', action='store_true', help="render every department of the export")
+    parser.add_argument('--output-dir', default=PRERENDER_OUTPUT_DIR, help="directory of the HTML files")
+    parser.add_argument('--mode', default=MAP_RENDER_MODE, choices=['auto', 'points', 'cluster', 'markers'],
+                        help="client layer of the maps")
+    parser.add_argument('--source', default=CLIENTS_CSV_URL, help="URL or path of the client export")
+    parser.add_argument('--jobs', type=int, default=PRERENDER_WORKERS, help="number of render processes")
+    parser.add_argument('--force', action='store_true', help="rebuild every map, even when its inputs are unchanged")
+    args = parser.parse_args(argv)
+    if not args.all and not args.departments:
+        parser.error("give some departments or --all")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    try:
+        clients = load_clients(args.source)
+    except (requests.RequestException, OSError, ValueError) as e:
+        logger.error("Could not load the client export: %s", e)
+        return EXIT_NO_DATA
+
+    index = DepartmentIndex(clients)
+    departments = index.options if args.all else args.departments
+    unknown = [department for department in departments if department not in index.rows]
+    if unknown:
+        logger.error("Unknown departments: %s", ", ".join(unknown))
+        return EXIT_USAGE
+
+    # Geocode every selected client once, then split them by department
+    selected = index.select(departments)
+    api_key = os.environ.get("OPENCAGE_API_KEY")
+    if not api_key:
+        logger.warning("OPENCAGE_API_KEY is not set: addresses missing from the store are placed approximately")
+    coords, errors = geocode_clients(selected, api_key, GeocodeStore())
+    if api_key and errors:
+        logger.warning("%d addresses could not be geocoded", len(errors))
+    geojson = load_departments_geojson()
+    located = locate_clients(selected, coords, load_centroids(), department_codes_by_name(geojson))
+
+    # Only departments whose rows, coordinates or render settings changed are rebuilt
+    rows = department_rows(located)
+    stamps = {
+        department: department_stamp(located.iloc[rows.get(department, [])], department, args.mode)
+        for department in departments
+    }
+    entries = read_manifest(args.output_dir)
+    stale = [
+        department for department in departments
+        if args.force or not is_current(entries.get(department), stamps[department], args.output_dir)
+    ]
+    logger.info("%d of %d departments changed since the last build", len(stale), len(departments))
+
+    geometry = DepartmentGeometry(geojson) if stale else None
+    os.makedirs(args.output_dir, exist_ok=True)
+    rebuilt, failures = [], {}
+    started = time.monotonic()
+    for department, entry, error in render_departments(
+        located, rows, geometry, stale, args.output_dir, args.mode, args.jobs
+    ):
+        if error is not None:
+            logger.error("Could not render %s:\n%s", department, error)
+            failures[department] = error.strip().splitlines()[-1]
+            continue
+        entries[department] = {**entry, 'stamp': stamps[department]}
+        rebuilt.append(department)
+        if entry['clients']:
+            logger.info("Rendered %s: %d clients -> %s", department, entry['clients'], entry['file'])
+        else:
+            logger.warning("No client of %s could be placed: rendered its outline only -> %s",
+                           department, entry['file'])
+    write_manifest(args.output_dir, entries, rebuilt, failures, args.mode)
+    logger.info(
+        "Rebuilt %d departments in %.1fs, %d unchanged: %s",
+        len(rebuilt), time.monotonic() - started, len(departments) - len(stale), ", ".join(sorted(rebuilt)) or "-",
+    )
+
+    failed = sorted(failures)
+    if failed:
+        logger.error("%d of %d departments failed: %s", len(failed), len(departments), ", ".join(failed))
+        return EXIT_FAILED
+    if api_key and any(is_transient(e) for e in errors.values()):
+        return EXIT_DEGRADED
+    return EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,229 @@
+import multiprocessing
+import os
+import pickle
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from addresses import normalize_street
+from geometry import DATA_DIR, department_code
+
+# Per-department address reference files in the Base Adresse Nationale CSV layout
+# (adresses-<department>.csv.gz from https://adresse.data.gouv.fr/data/ban/adresses/latest/csv/)
+ADDRESS_REFERENCE_DIR = os.environ.get("ADDRESS_REFERENCE_DIR", os.path.join(DATA_DIR, "ban"))
+ADDRESS_REFERENCE_WORKERS = int(os.environ.get("ADDRESS_REFERENCE_WORKERS", str(os.cpu_count() or 1)))
+# Below this many queries, departments are matched in the calling process
+ADDRESS_REFERENCE_POOL_MIN = int(os.environ.get("ADDRESS_REFERENCE_POOL_MIN", "2000"))
+
+# Minimum share of street tokens a reference street must have in common with the query
+STREET_MATCH_THRESHOLD = 0.6
+
+# Tokens too common to tell two streets apart
+STOPWORDS = {'a', 'au', 'aux', 'd', 'de', 'des', 'du', 'en', 'et', 'l', 'la', 'le', 'les', 'sur'}
+
+_QUERY_PATTERN = re.compile(r'^(?:(\d+)\s*(bis|ter|quater|[a-z])?\s+)?(.*)$')
+
+
+def reference_path(department, directory=ADDRESS_REFERENCE_DIR):
+    """Return the reference file of a department, or None if it is not installed."""
+    for name in (f"adresses-{department}.csv.gz", f"adresses-{department}.csv"):
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def parse_query(query):
+    """
+    Split a normalized query into its house number, street and postal code.
+
+    Parameters:
+        query (str): A query built by addresses.normalize_address.
+
+    Returns:
+        tuple: (number or None, suffix or None, street, postal code or None)
+    """
+    parts = query.split(', ')
+    postal_code = re.match(r'(\d{5})\b', parts[1]) if len(parts) > 2 else None
+    number, suffix, street = _QUERY_PATTERN.match(parts[0]).groups()
+    return (
+        int(number) if number else None,
+        suffix,
+        street,
+        postal_code.group(1) if postal_code else None,
+    )
+
+
+def street_tokens(street):
+    return set(street.split()) - STOPWORDS
+
+
+class StreetIndex:
+    """
+    Address reference of one department, indexed by postal code and street token.
+
+    Parameters:
+        reference (DataFrame): BAN rows with 'numero', 'rep', 'nom_voie',
+            'code_postal', 'lat' and 'lon' columns.
+    """
+
+    def __init__(self, reference):
+        reference = reference.dropna(subset=['nom_voie', 'code_postal', 'lat', 'lon'])
+        streets = reference['nom_voie'].drop_duplicates()
+        keys = dict(zip(streets, (normalize_street(street) for street in streets)))
+        reference = reference.assign(street=reference['nom_voie'].map(keys))
+
+        self.numbers = {}
+        self.tokens = {}
+        for (postal_code, street), rows in reference.groupby(['code_postal', 'street'], sort=False):
+            self.numbers[(postal_code, street)] = rows[['numero', 'rep', 'lat', 'lon']].to_numpy()
+            for token in street_tokens(street):
+                self.tokens.setdefault((postal_code, token), set()).add(street)
+
+    def match_street(self, street, postal_code):
+        """Return the reference street of a postal code closest to a street, or None."""
+        tokens = street_tokens(street)
+        candidates = set().union(*(self.tokens.get((postal_code, token), ()) for token in tokens))
+        best, best_score = None, STREET_MATCH_THRESHOLD
+        for candidate in candidates:
+            candidate_tokens = street_tokens(candidate)
+            score = len(tokens & candidate_tokens) / len(tokens | candidate_tokens)
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best
+
+    def match(self, query):
+        """
+        Geocode a normalized query against the reference.
+
+        The exact house number is used when present, else the nearest number
+        on the same street, else the middle of the street.
+
+        Returns:
+            tuple: (lat, lng) or None if the street is not found.
+        """
+        number, suffix, street, postal_code = parse_query(query)
+        if postal_code is None:
+            return None
+        street = self.match_street(street, postal_code)
+        if street is None:
+            return None
+        rows = self.numbers[(postal_code, street)]
+        if number is None:
+            lat, lng = rows[:, 2].mean(), rows[:, 3].mean()
+            return float(lat), float(lng)
+        distances = [
+            abs(row_number - number) + (0 if (row_suffix or None) == suffix else 0.5)
+            for row_number, row_suffix in zip(rows[:, 0], rows[:, 1])
+        ]
+        row = rows[min(range(len(rows)), key=distances.__getitem__)]
+        return float(row[2]), float(row[3])
+
+
+def read_reference(path):
+    """Read the columns of a BAN reference file needed for matching."""
+    reference = pd.read_csv(
+        path,
+        sep=';',
+        usecols=['numero', 'rep', 'nom_voie', 'code_postal', 'lon', 'lat'],
+        dtype={'numero': 'Int64', 'rep': object, 'nom_voie': object, 'code_postal': object},
+    )
+    reference['rep'] = reference['rep'].where(reference['rep'].notna(), None)
+    return reference
+
+
+# Street indexes already loaded by this process: path -> (file stamp, StreetIndex)
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_street_index(path):
+    """
+    Return the StreetIndex of a reference file, built once.
+
+    The index is kept in memory for the life of the process and pickled next
+    to the reference file, so other processes and later runs load it instead
+    of parsing the CSV again. Both are rebuilt when the reference file changes.
+    """
+    stamp = _file_stamp(path)
+    with _indexes_lock:
+        cached = _indexes.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        index = None
+        cache_path = path + '.index.pickle'
+        try:
+            with open(cache_path, 'rb') as file:
+                cached_stamp, index = pickle.load(file)
+            if cached_stamp != stamp:
+                index = None
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            index = None
+        if index is None:
+            index = StreetIndex(read_reference(path))
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'wb') as file:
+                    pickle.dump((stamp, index), file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                # A read-only reference directory only costs the on-disk cache
+                pass
+        _indexes[path] = (stamp, index)
+        return index
+
+
+def match_department(path, queries):
+    """Match the queries of one department against its reference file."""
+    index = load_street_index(path)
+    matches = {}
+    for query in queries:
+        latlng = index.match(query)
+        if latlng is not None:
+            matches[query] = latlng
+    return matches
+
+
+def geocode_locally(queries, directory=ADDRESS_REFERENCE_DIR, max_workers=ADDRESS_REFERENCE_WORKERS):
+    """
+    Geocode normalized queries against the installed reference files.
+
+    Queries are grouped by department and matched against the department's
+    cached StreetIndex. Large batches spanning several departments are
+    matched in worker processes; interactive lookups stay in this process.
+
+    Parameters:
+        queries (iterable): Queries built by addresses.normalize_address.
+        directory (str): Directory of the per-department reference files.
+        max_workers (int): Number of worker processes.
+
+    Returns:
+        dict: Query -> (lat, lng) for every query found in the reference.
+    """
+    groups = {}
+    for query in queries:
+        postal_code = parse_query(query)[3]
+        path = reference_path(department_code(postal_code), directory) if postal_code else None
+        if path is not None:
+            groups.setdefault(path, []).append(query)
+    if not groups:
+        return {}
+    if len(groups) == 1 or max_workers <= 1 or sum(map(len, groups.values())) < ADDRESS_REFERENCE_POOL_MIN:
+        matches = {}
+        for path, group in groups.items():
+            matches.update(match_department(path, group))
+        return matches
+
+    # Spawned workers: forking a multi-threaded server process is not safe
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(groups)), mp_context=context) as pool:
+        results = pool.map(match_department, list(groups), list(groups.values()))
+        return {query: latlng for result in results for query, latlng in result.items()}
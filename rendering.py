@@ -0,0 +1,336 @@
+import hashlib
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import folium
+import pandas as pd
+from folium.plugins import FastMarkerCluster
+
+from geometry import zoom_for_bounds
+
+# 'points' draws every client in a single GeoJSON layer, 'cluster' clusters them in the
+# browser, 'server' sends precomputed cluster centroids, 'markers' adds one Marker per
+# client and 'auto' picks 'cluster' then 'server' above their thresholds
+MAP_RENDER_MODE = os.environ.get("MAP_RENDER_MODE", "auto")
+MAP_CLUSTER_THRESHOLD = int(os.environ.get("MAP_CLUSTER_THRESHOLD", "500"))
+MAP_SERVER_CLUSTER_THRESHOLD = int(os.environ.get("MAP_SERVER_CLUSTER_THRESHOLD", "20000"))
+
+# Rendered maps kept in memory, evicted least recently used first
+MAP_RENDER_CACHE_SIZE = int(os.environ.get("MAP_RENDER_CACHE_SIZE", "64"))
+MAP_RENDER_CACHE_BYTES = int(os.environ.get("MAP_RENDER_CACHE_BYTES", str(256 * 1024 * 1024)))
+
+# Server-side cluster indexes kept in memory, one per department selection
+MAP_CLUSTER_INDEX_CACHE_SIZE = int(os.environ.get("MAP_CLUSTER_INDEX_CACHE_SIZE", "16"))
+MAP_CLUSTER_INDEX_TTL = float(os.environ.get("MAP_CLUSTER_INDEX_TTL", str(24 * 3600)))  # seconds
+
+# Client columns shown in the popups, with their labels
+POPUP_FIELDS = {
+    'Name': 'Name:',
+    'Address': 'Address:',
+    'AdministrativeArea2': 'Department:',
+    'Precision': 'Precision:',
+}
+
+
+def department_style(feature):
+    """Style shared by every department outline."""
+    return {
+        "fillColor": "orange",
+        "color": "black",
+        "weight": 0.5,
+        "fillOpacity": 0.2,
+    }
+
+
+def points_geojson(data, fields=tuple(POPUP_FIELDS)):
+    """
+    Build one FeatureCollection of client points straight from the DataFrame columns.
+
+    Parameters:
+        data (DataFrame): Clients with 'lat' and 'lng' columns.
+        fields (tuple): Columns copied into the feature properties.
+
+    Returns:
+        dict: A FeatureCollection with one Point per client.
+    """
+    coordinates = data[['lng', 'lat']].round(6).to_numpy().tolist()
+    properties = data[list(fields)].astype(str).to_dict(orient='records')
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': point}, 'properties': props}
+            for point, props in zip(coordinates, properties)
+        ],
+    }
+
+
+def add_point_layer(folium_map, data):
+    """Draw every client as a circle of a single GeoJSON layer with shared styling."""
+    folium.GeoJson(
+        points_geojson(data),
+        name="Clients",
+        marker=folium.CircleMarker(
+            radius=6,
+            color='darkgreen',
+            weight=1,
+            fill=True,
+            fill_color='green',
+            fill_opacity=0.8,
+        ),
+        popup=folium.GeoJsonPopup(fields=list(POPUP_FIELDS), aliases=list(POPUP_FIELDS.values())),
+    ).add_to(folium_map)
+
+
+# Builds a circle marker with its popup from a [lat, lng, *POPUP_FIELDS] row
+CLUSTER_CALLBACK = """
+function (row) {
+    var escape = function (value) {
+        return String(value).replace(/[&<>"']/g, function (c) { return '&#' + c.charCodeAt(0) + ';'; });
+    };
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: 6, color: 'darkgreen', weight: 1, fill: true, fillColor: 'green', fillOpacity: 0.8
+    });
+    marker.bindPopup(LABELS.map(function (label, i) {
+        return '<b>' + label + '</b> ' + escape(row[i + 2]);
+    }).join('<br>'));
+    return marker;
+}
+"""
+
+
+def add_cluster_layer(folium_map, data):
+    """Cluster the clients in the browser from one compact array of rows."""
+    rows = data[['lat', 'lng']].round(6).join(data[list(POPUP_FIELDS)].astype(str))
+    FastMarkerCluster(
+        rows.to_numpy().tolist(),
+        callback=CLUSTER_CALLBACK.replace("LABELS", json.dumps(list(POPUP_FIELDS.values()))),
+        name="Clients",
+    ).add_to(folium_map)
+
+
+def add_centroid_layer(folium_map, clusters):
+    """Draw server-side cluster centroids as circles sized by their number of clients."""
+    rows = clusters[['lng', 'lat']].round(6).to_numpy().tolist()
+    counts = clusters['count'].astype(int).tolist()
+    folium.GeoJson(
+        {
+            'type': 'FeatureCollection',
+            'features': [
+                {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': point}, 'properties': {'count': count}}
+                for point, count in zip(rows, counts)
+            ],
+        },
+        name="Clients",
+        marker=folium.CircleMarker(color='darkgreen', weight=1, fill=True, fill_color='green', fill_opacity=0.6),
+        style_function=lambda feature: {'radius': 6 + round(3 * math.log2(feature['properties']['count']))},
+        tooltip=folium.GeoJsonTooltip(fields=['count'], aliases=['Dispositifs :']),
+    ).add_to(folium_map)
+
+
+def choose_mode(count, mode=MAP_RENDER_MODE):
+    """Resolve the 'auto' render mode from the number of clients to draw."""
+    if mode != 'auto':
+        return mode
+    if count > MAP_SERVER_CLUSTER_THRESHOLD:
+        return 'server'
+    if count > MAP_CLUSTER_THRESHOLD:
+        return 'cluster'
+    return 'points'
+
+
+def add_markers(folium_map, data):
+    """Add one Marker per client."""
+    for _, row in data.iterrows():
+        popup_content = f"""
+        bName:/b {row['Name']}br
+        bAddress:/b {row['Address']}br
+        bDepartment:/b {row['AdministrativeArea2']}br
+        bPrecision:/b {row['Precision']}br
+        """
+        folium.Marker(
+            location=[row['lat'], row['lng']],
+            popup=popup_content,
+            icon=folium.Icon(color='darkgreen'),
+        ).add_to(folium_map)
+
+
+def build_map(data, outlines, zoom, mode=MAP_RENDER_MODE, index=None, view=None, location=None):
+    """
+    Build the folium map of the clients over the department outlines.
+
+    Parameters:
+        data (DataFrame): Geocoded clients.
+        outlines (dict): FeatureCollection of the departments to draw.
+        zoom (int): Initial zoom level.
+        mode (str): 'auto', 'points', 'cluster', 'server' or 'markers'.
+        index (ClusterIndex): Cluster index of the clients, required by 'server'.
+        view (tuple): (zoom, bounds) the user is looking at, for 'server'.
+        location (list): [lat, lng] center, by default the average location of the clients.
+
+    Returns:
+        folium.Map: The map.
+    """
+    # Center the map on the average location of the clients
+    if location is None:
+        location = [data['lat'].mean(), data['lng'].mean()]
+    folium_map = folium.Map(location=location, zoom_start=zoom)
+
+    # Add GeoJSON overlay for French departments
+    folium.GeoJson(
+        outlines,
+        name="French Departments",
+        style_function=department_style,
+    ).add_to(folium_map)
+
+    if data.empty:
+        return folium_map
+
+    mode = choose_mode(len(data), mode)
+    if mode == 'server':
+        add_server_layer(folium_map, data, index, view or (zoom, None))
+    elif mode == 'markers':
+        add_markers(folium_map, data)
+    elif mode == 'cluster':
+        add_cluster_layer(folium_map, data)
+    else:
+        add_point_layer(folium_map, data)
+    return folium_map
+
+
+def add_server_layer(parent, data, index, view):
+    """
+    Add the clients of the current view, as the server mode sends them.
+
+    Parameters:
+        parent (folium.Map or folium.FeatureGroup): Where to add the layer.
+        data (DataFrame): Geocoded clients.
+        index (ClusterIndex): Cluster index of the clients.
+        view (tuple): (zoom, bounds) the user is looking at; bounds may be None.
+    """
+    zoom, bounds = view
+    if bounds is None or zoom < index.detail_zoom:
+        add_centroid_layer(parent, index.clusters(zoom, bounds))
+        return
+    # Zoomed in far enough: send the individual clients of the view, if any
+    visible = data[data['Name'].isin(index.keys_in(bounds))]
+    if not visible.empty:
+        add_point_layer(parent, visible)
+
+
+def department_frame(data, geometry, departments):
+    """
+    Return the outlines, zoom and center framing some departments' clients.
+
+    Parameters:
+        data (DataFrame): Geocoded clients of the departments.
+        geometry (DepartmentGeometry): The precomputed department outlines.
+        departments (iterable): Department names, resolved together with the
+                                clients' postal codes.
+
+    Returns:
+        tuple: (FeatureCollection of the departments and their neighbours,
+                zoom level, [lat, lng] center)
+    """
+    codes = geometry.codes_for(departments, data['PostalCode'].dropna())
+    zoom = zoom_for_bounds(geometry.bounds(codes)) if codes else 6
+    outlines = geometry.feature_collection(geometry.with_neighbours(codes) if codes else geometry.layout, zoom)
+    if data.empty:
+        (south, west), (north, east) = geometry.bounds(codes or geometry.layout)
+        location = [(south + north) / 2, (west + east) / 2]
+    else:
+        location = [data['lat'].mean(), data['lng'].mean()]
+    return outlines, zoom, location
+
+
+def build_department_map(data, geometry, departments, mode=MAP_RENDER_MODE, index=None, view=None):
+    """
+    Build the map of some departments' clients, framed on those departments.
+
+    Only the departments and their neighbours are embedded, simplified for
+    the zoom level that fits them. Without any placed client the map shows
+    the outlines alone, centered on the departments.
+
+    Parameters:
+        data (DataFrame): Geocoded clients of the departments.
+        geometry (DepartmentGeometry): The precomputed department outlines.
+        departments (iterable): Department names, resolved together with the
+                                clients' postal codes.
+        mode, index, view: As for build_map.
+
+    Returns:
+        folium.Map: The map.
+    """
+    outlines, zoom, location = department_frame(data, geometry, departments)
+    return build_map(data, outlines, zoom, mode, index=index, view=view, location=location)
+
+
+def render_html(folium_map):
+    """Render a folium map to a standalone HTML document in memory."""
+    return folium_map.get_root().render()
+
+
+def data_version(data, columns=('Name', 'Address', 'PostalCode', 'AdministrativeArea2', 'Precision', 'lat', 'lng')):
+    """Return a stamp that changes whenever the rendered client rows or coordinates change."""
+    hashes = pd.util.hash_pandas_object(data[[c for c in columns if c in data]], index=False)
+    return hashlib.sha1(hashes.to_numpy().tobytes()).hexdigest()
+
+
+class RenderCache:
+    """
+    Bounded LRU cache of rendered map HTML, shared by every session of a process.
+
+    Parameters:
+        max_entries (int): Maximum number of maps kept.
+        max_bytes (int): Maximum total size of the kept maps.
+    """
+
+    def __init__(self, max_entries=MAP_RENDER_CACHE_SIZE, max_bytes=MAP_RENDER_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the HTML bytes rendered for a key, or None."""
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def put(self, key, html):
+        """Store the HTML bytes of a key, evicting the least recently used maps."""
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = html
+            self._size += len(html)
+            while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+        return html
+
+    def get_or_render(self, key, render):
+        """
+        Return the cached HTML of a key, rendering and storing it on a miss.
+
+        Parameters:
+            key (hashable): Selection, data version and render settings.
+            render (callable): Returns the map HTML as a string.
+
+        Returns:
+            bytes: The UTF-8 encoded HTML.
+        """
+        html = self.get(key)
+        if html is None:
+            html = self.put(key, render().encode('utf-8'))
+        return html
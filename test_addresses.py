@@ -0,0 +1,31 @@
+import pytest
+
+from addresses import normalize_address, split_address
+
+
+@pytest.mark.parametrize("address, postal_code, locality, expected", [
+    # Street names ending like the country or the town keep their name
+    ("12 avenue Anatole France", "92300", "Levallois-Perret",
+     "12 avenue anatole france, 92300 levallois perret, france"),
+    ("3 rue de France", "06000", "Nice", "3 rue de france, 06000 nice, france"),
+    ("10 rue de Paris", "77000", "Paris", "10 rue de paris, 77000 paris, france"),
+    ("2 rue Saint-Denis", "93200", "Saint-Denis", "2 rue saint denis, 93200 saint denis, france"),
+    # The export format: postal code, locality and country after commas
+    ("15 Rue du Général de Gaulle, 02120 Sains-Richaumont, France", "02120", "Sains-Richaumont",
+     "15 rue du general de gaulle, 02120 sains richaumont, france"),
+    ("15 Av. de Bresse, 01460 Montréal-la-Cluse, France", None, None,
+     "15 avenue de bresse, 01460 montreal la cluse, france"),
+    # Without commas the place starts at the postal code
+    ("2 rue Saint-Denis 93200 Saint-Denis France", None, None, "2 rue saint denis, 93200 saint denis, france"),
+    ("5 Bd Haussmann, 75009 Paris Cedex 09, FRANCE", None, None, "5 boulevard haussmann, 75009 paris, france"),
+])
+def test_normalize_address(address, postal_code, locality, expected):
+    assert normalize_address(address, postal_code, locality) == expected
+
+
+def test_streets_of_one_town_stay_distinct():
+    assert normalize_address("1 rue de Paris", "06000", "Nice") != normalize_address("1 rue de France", "06000", "Nice")
+
+
+def test_split_address_keeps_trailing_country_in_street_without_place():
+    assert split_address("12 avenue Anatole France") == ("12 avenue anatole france", "")